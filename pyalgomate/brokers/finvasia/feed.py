@@ -2,31 +2,45 @@
 .. moduleauthor:: Nagaraju Gunda
 """
 
-import asyncio
 import datetime
 import logging
 import os
-import pickle
 import tempfile
 import threading
+import time
 import traceback
+import msgpack
 import numpy as np
-from queue import Queue
+from collections import defaultdict
+from dataclasses import dataclass
+from math import ceil
+from queue import SimpleQueue
 from typing import Optional, Tuple
 
 import zmq
-import zmq.asyncio
 from NorenRestApiPy.NorenApi import NorenApi
 from pyalgotrade import bar
 
 from pyalgomate.barfeed import BaseBarFeed
 from pyalgomate.barfeed.BasicBarEx import BasicBarEx
 from pyalgomate.core import OptionType
+from pyalgomate.strategies import OptionContract
 
 from . import getOptionContract
 
 logger = logging.getLogger(__name__)
 
+_TICK_INV = 20  # 1 / 0.05, where 0.05 is the tick size
+
+
+@dataclass
+class TokenMeta:
+    __slots__ = ("instrument", "exchange", "optionContract")
+
+    instrument: str
+    exchange: str
+    optionContract: Optional[OptionContract]
+
 
 class QuoteMessage(object):
     # t	tk	‘tk’ represents touchline acknowledgement
@@ -52,9 +66,9 @@ class QuoteMessage(object):
     # sq1		Best Sell Quantity 1
     # sp1		Best Sell Price 1
 
-    def __init__(self, eventDict, tokenMappings):
+    def __init__(self, eventDict, tokenMeta: TokenMeta):
         self.__eventDict = eventDict
-        self.__tokenMappings = tokenMappings
+        self.__tokenMeta = tokenMeta
 
     def __str__(self):
         return f"{self.__eventDict}"
@@ -73,24 +87,34 @@ class QuoteMessage(object):
 
     @property
     def dateTime(self):
-        return self.__eventDict["ft"]
+        # ft is published as epoch milliseconds by the websocket client
+        return datetime.datetime.fromtimestamp(self.__eventDict["ft"] / 1000)
 
     @property
     def price(self):
-        return float(self.__eventDict.get("lp", 0))
+        return QuoteMessage.getPrice(self.__eventDict)
 
     @property
     def microprice(self):
+        return QuoteMessage.getMicroPrice(self.__eventDict)
+
+    # The static helpers below let hot paths read a quote dict directly
+    # without wrapping it in a QuoteMessage first
+    @staticmethod
+    def getPrice(eventDict):
+        return float(eventDict.get("lp", 0))
+
+    @staticmethod
+    def getMicroPrice(eventDict):
         try:
-            bbp = float(self.__eventDict.get("bp1", 0))  # Buying Price 1
-            bap = float(self.__eventDict.get("sp1", 0))  # Sell Price 1
-            bbq = int(self.__eventDict.get("bq1", 0))  # Buying quantity 1
-            baq = int(self.__eventDict.get("sq1", 0))  # Sell Qty 1
+            bbp = float(eventDict.get("bp1", 0))  # Buying Price 1
+            bap = float(eventDict.get("sp1", 0))  # Sell Price 1
+            bbq = int(eventDict.get("bq1", 0))  # Buying quantity 1
+            baq = int(eventDict.get("sq1", 0))  # Sell Qty 1
             mpp = ((bap * bbq) + (bbp * baq)) / (bbq + baq)
-            p = int(1 / 0.05)  # 0.05 is tick size
-            return float(np.ceil(mpp * p) / p)
-        except Exception:
-            return self.price
+            return ceil(mpp * _TICK_INV) / _TICK_INV
+        except (ZeroDivisionError, KeyError, ValueError):
+            return QuoteMessage.getPrice(eventDict)
 
     @property
     def volume(self):
@@ -102,11 +126,11 @@ class QuoteMessage(object):
 
     @property
     def seq(self):
-        return int(self.dateTime)
+        return int(self.__eventDict["ft"])
 
     @property
     def instrument(self):
-        return f"{self.exchange}|{self.__tokenMappings[f'{self.exchange}|{self.scriptToken}'].split('|')[1]}"
+        return self.__tokenMeta.instrument
 
     def getBar(self, dateTime=None) -> BasicBarEx:
         open = high = low = close = self.price
@@ -129,6 +153,7 @@ class QuoteMessage(object):
 
 
 class LiveTradeFeed(BaseBarFeed):
+    RECEIVE_TIMEOUT = 1000  # milliseconds
 
     def __init__(
         self,
@@ -160,15 +185,57 @@ class LiveTradeFeed(BaseBarFeed):
         for key, value in self.__instrumentToTokenIdMapping.items():
             self.registerDataSeries(key)
 
+        # Instrument names and option contracts are resolved once per token
+        # here rather than reparsed on every tick or option search
+        self.__tokenMeta = {
+            tokenId: self.__createTokenMeta(tokenId)
+            for tokenId in self.__instrumentToTokenIdMapping.values()
+        }
+
+        # Options sharing an (expiry, type) are given adjacent positions, so
+        # each such bucket is a contiguous slice of the arrays below
+        optionBuckets = defaultdict(list)
+        self.__tokenIds = []
+        for tokenId in self.__instrumentToTokenIdMapping.values():
+            optionContract = self.__tokenMeta[tokenId].optionContract
+            if optionContract is None:
+                self.__tokenIds.append(tokenId)
+            else:
+                optionBuckets[(optionContract.expiry, optionContract.type)].append(
+                    tokenId
+                )
+        self.__optionBuckets = {}
+        for key, tokenIds in optionBuckets.items():
+            start = len(self.__tokenIds)
+            self.__tokenIds.extend(tokenIds)
+            self.__optionBuckets[key] = slice(start, len(self.__tokenIds))
+
+        # Every subscribed token gets a fixed position; the latest quote
+        # state lives in parallel arrays at that position, so memory is
+        # bounded by the subscription and scans are contiguous numpy passes
+        self.__tokenIndex = {
+            tokenId: index for index, tokenId in enumerate(self.__tokenIds)
+        }
+        self.__tokenInstruments = [
+            self.__tokenMeta[tokenId].instrument for tokenId in self.__tokenIds
+        ]
+        tokenCount = len(self.__tokenIds)
+        self.__prices = np.full(tokenCount, np.nan)
+        self.__volumes = np.zeros(tokenCount)
+        self.__ois = np.zeros(tokenCount)
+        self.__timestamps = np.zeros(tokenCount, dtype=np.int64)
+        self.__latestQuotes = [None] * tokenCount
+
         self.__stopped = False
-        self.__lastQuoteDateTime = None
-        self.__lastReceivedDateTime = None
+        self.__lastQuoteTimestamp = None
+        self.__lastReceivedTime = None
         self.__lastUpdateTime = None
         self.__nextBarsTime = None
 
         # ZeroMQ setup
-        self.__context = zmq.asyncio.Context()
+        self.__context = zmq.Context()
         self.__socket = self.__context.socket(zmq.SUB)
+        self.__socket.setsockopt(zmq.RCVTIMEO, self.RECEIVE_TIMEOUT)
 
         if ipc_path is None:
             # Create a platform-independent IPC path
@@ -184,15 +251,41 @@ class LiveTradeFeed(BaseBarFeed):
         else:
             self.__socket.connect(f"ipc://{self.__ipc_path}")
 
-        self.__socket.setsockopt_string(zmq.SUBSCRIBE, "FEED_UPDATE")
+        self.__socket.setsockopt_string(zmq.SUBSCRIBE, "FEED_BATCH")
 
-        self.__latestQuotes = {}
-        self.__latestOIs = {}
+        self.__quotesLock = threading.Lock()
+        self.__pendingBatches = SimpleQueue()
 
-        # Thread to run the asyncio event loop
+        # Threads to receive feed batches and to apply them
         self.__loopThread = threading.Thread(target=self.__run_event_loop)
+        self.__decodeThread = threading.Thread(target=self.__run_decode_loop)
+        self.__decodeThread.start()
         self.__loopThread.start()
 
+    def __createTokenMeta(self, tokenId) -> TokenMeta:
+        instrument = self.__tokenIdToInstrumentMappings[tokenId]
+        return TokenMeta(
+            instrument, instrument.split("|")[0], getOptionContract(instrument)
+        )
+
+    def __getBar(self, index, dateTime) -> BasicBarEx:
+        price = float(self.__prices[index])
+        return BasicBarEx(
+            dateTime,
+            price,
+            price,
+            price,
+            price,
+            float(self.__volumes[index]),
+            None,
+            bar.Frequency.TRADE,
+            {
+                "Instrument": self.__tokenInstruments[index],
+                "Open Interest": float(self.__ois[index]),
+                "Message": self.__latestQuotes[index],
+            },
+        )
+
     def getApi(self):
         return self.__api
 
@@ -203,77 +296,117 @@ class LiveTradeFeed(BaseBarFeed):
         return False
 
     def getLastBar(self, instrument):
-        lastBarQuote = self.__latestQuotes.get(
-            self.__instrumentToTokenIdMapping[instrument], None
-        )
-        if lastBarQuote is not None:
-            return QuoteMessage(
-                lastBarQuote, self.__tokenIdToInstrumentMappings
-            ).getBar()
+        index = self.__tokenIndex[self.__instrumentToTokenIdMapping[instrument]]
+        if self.__latestQuotes[index] is not None:
+            return self.__getBar(
+                index,
+                datetime.datetime.fromtimestamp(self.__timestamps[index] / 1000),
+            )
         return None
 
     def getMicroPrice(self, instrument) -> float:
-        lastBarQuote = self.__latestQuotes.get(
-            self.__instrumentToTokenIdMapping[instrument], None
-        )
+        lastBarQuote = self.__latestQuotes[
+            self.__tokenIndex[self.__instrumentToTokenIdMapping[instrument]]
+        ]
         if lastBarQuote is not None:
-            return float(
-                QuoteMessage(
-                    lastBarQuote, self.__tokenIdToInstrumentMappings
-                ).microprice
-            )
+            return QuoteMessage.getMicroPrice(lastBarQuote)
         return 0
 
     def __run_event_loop(self):
-        asyncio.run(self.__async_main())
-
-    async def __async_main(self):
+        # Only receives; decoding happens on the decode thread so the socket
+        # is drained as fast as batches arrive
         while not self.__stopped:
             try:
-                topic, message = await self.__socket.recv_multipart(flags=zmq.NOBLOCK)
-                message = pickle.loads(message)
-                key = message["e"] + "|" + message["tk"]
-                if float(message.get("lp", 0)) <= 0:
-                    continue
-                if key in self.__latestQuotes:
-                    symbolInfo = self.__latestQuotes[key]
-                    symbolInfo.update(message)
-                    self.__latestQuotes[key] = symbolInfo
-                else:
-                    self.__latestQuotes[key] = message
-
-                if message.get("oi", None) is not None:
-                    self.__latestOIs[key] = float(message["oi"])
-
-                self.__lastQuoteDateTime = message["ft"]
-                self.__lastReceivedDateTime = datetime.datetime.now()
+                topic, message = self.__socket.recv_multipart()
             except zmq.Again:
-                await asyncio.sleep(0.01)
+                # RCVTIMEO expired; loop around to re-check for stop()
+                continue
 
-    def getNextBars(self):
-        def getBar(message, lastQuoteDateTime):
-            if not message.get("oi", None):
-                message["oi"] = self.__latestOIs.get(
-                    message["e"] + "|" + message["tk"], 0
-                )
-            bar = QuoteMessage(message, self.__tokenIdToInstrumentMappings).getBar(
-                lastQuoteDateTime
-            )
-            return bar.getInstrument(), bar
+            if topic != b"FEED_BATCH":
+                logger.warning(f"Ignoring message on unexpected topic {topic}")
+                continue
+
+            self.__lastReceivedTime = time.time()
+            self.__pendingBatches.put(message)
+
+        self.__pendingBatches.put(None)
+
+    def __run_decode_loop(self):
+        while True:
+            message = self.__pendingBatches.get()
+            if message is None:
+                break
+
+            try:
+                batch = msgpack.unpackb(message, raw=False, strict_map_key=False)
+            except Exception as e:
+                logger.error(f"Failed to decode feed batch: {e}")
+                continue
+
+            if not isinstance(batch, dict):
+                logger.error(f"Ignoring malformed feed batch of type {type(batch)}")
+                continue
+
+            with self.__quotesLock:
+                for key, message in batch.items():
+                    index = self.__tokenIndex.get(key)
+                    if index is None:
+                        # Published by the websocket client for another feed
+                        continue
 
+                    price = float(message.get("lp", 0))
+                    if price <= 0:
+                        continue
+
+                    # Each published message carries the full latest state
+                    # of the token, so it replaces what was stored before
+                    self.__latestQuotes[index] = message
+                    self.__prices[index] = price
+                    self.__volumes[index] = float(message.get("volume", 0))
+                    if message.get("oi", None) is not None:
+                        self.__ois[index] = float(message["oi"])
+                    self.__timestamps[index] = message["ft"]
+
+                    self.__lastQuoteTimestamp = message["ft"]
+
+    def getNextBars(self):
         bars = None
-        lastQuoteDateTime = self.__lastQuoteDateTime
-        if self.__lastUpdateTime != lastQuoteDateTime:
+        lastQuoteTimestamp = self.__lastQuoteTimestamp
+        if self.__lastUpdateTime != lastQuoteTimestamp:
             self.__nextBarsTime = datetime.datetime.now()
-            self.__lastUpdateTime = lastQuoteDateTime
+            self.__lastUpdateTime = lastQuoteTimestamp
             barDateTime = self.__nextBarsTime.replace(microsecond=0)
-            bars = bar.Bars(
-                {
-                    instrument: bar
-                    for quoteMessage in list(self.__latestQuotes.values())
-                    for instrument, bar in [getBar(quoteMessage, barDateTime)]
-                }
-            )
+            # Take a consistent copy of the latest state so that a bar never
+            # mixes fields from two different decoded batches
+            with self.__quotesLock:
+                quotes = list(self.__latestQuotes)
+                prices = self.__prices.tolist()
+                volumes = self.__volumes.tolist()
+                ois = self.__ois.tolist()
+
+            barsDict = {}
+            frequency = bar.Frequency.TRADE
+            for index, instrument in enumerate(self.__tokenInstruments):
+                quote = quotes[index]
+                if quote is None:
+                    continue
+                price = prices[index]
+                barsDict[instrument] = BasicBarEx(
+                    barDateTime,
+                    price,
+                    price,
+                    price,
+                    price,
+                    volumes[index],
+                    None,
+                    frequency,
+                    {
+                        "Instrument": instrument,
+                        "Open Interest": ois[index],
+                        "Message": quote,
+                    },
+                )
+            bars = bar.Bars(barsDict)
         return bars
 
     def peekDateTime(self):
@@ -295,9 +428,10 @@ class LiveTradeFeed(BaseBarFeed):
 
     def stop(self):
         self.__stopped = True
+        self.__loopThread.join()
+        self.__decodeThread.join()
         self.__socket.close()
         self.__context.term()
-        self.__loopThread.join()
 
     def join(self):
         pass
@@ -309,20 +443,25 @@ class LiveTradeFeed(BaseBarFeed):
         return None
 
     def getLastUpdatedDateTime(self):
-        return self.__lastQuoteDateTime
+        if self.__lastQuoteTimestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.__lastQuoteTimestamp / 1000)
 
     def getLastReceivedDateTime(self):
-        return self.__lastReceivedDateTime
+        if self.__lastReceivedTime is None:
+            return None
+        return datetime.datetime.fromtimestamp(self.__lastReceivedTime)
 
     def getNextBarsDateTime(self):
         return self.__nextBarsTime
 
     def isDataFeedAlive(self, heartBeatInterval=5):
-        if self.__lastQuoteDateTime is None:
+        lastQuoteDateTime = self.getLastUpdatedDateTime()
+        if lastQuoteDateTime is None:
             return False
 
         currentDateTime = datetime.datetime.now()
-        timeSinceLastDateTime = currentDateTime - self.__lastQuoteDateTime
+        timeSinceLastDateTime = currentDateTime - lastQuoteDateTime
         return timeSinceLastDateTime.total_seconds() <= heartBeatInterval
 
     def findNearestPremiumOption(
@@ -332,29 +471,15 @@ class LiveTradeFeed(BaseBarFeed):
         premium: float,
         time: datetime.datetime,
     ) -> Optional[Tuple[str, float]]:
-        nearestOption = None
-        nearestPremium = None
-        minDifference = float("inf")
-
-        for tokenId, quote in self.__latestQuotes.items():
-            instrument = self.__tokenIdToInstrumentMappings[tokenId]
-            optionContract = getOptionContract(instrument)
-
-            if (
-                optionContract is None
-                or optionContract.expiry != expiry
-                or optionContract.type
-                != ("c" if optionType == OptionType.CALL else "p")
-            ):
-                continue
-
-            close = QuoteMessage(quote, self.__tokenIdToInstrumentMappings).price
-
-            difference = abs(close - premium)
+        bucket = self.__optionBuckets.get(
+            (expiry, "c" if optionType == OptionType.CALL else "p")
+        )
+        if bucket is None:
+            return None, None
 
-            if difference < minDifference:
-                minDifference = difference
-                nearestOption = instrument
-                nearestPremium = close
+        differences = np.abs(self.__prices[bucket] - premium)
+        if np.isnan(differences).all():
+            return None, None
 
-        return nearestOption, nearestPremium
+        index = bucket.start + int(np.nanargmin(differences))
+        return self.__tokenInstruments[index], float(self.__prices[index])
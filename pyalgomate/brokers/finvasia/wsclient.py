@@ -20,10 +20,10 @@ sys.path.append(
 import datetime
 import json
 import logging
-import pickle
 import threading
 import time
 
+import msgpack
 import yaml
 import zmq
 from NorenRestApiPy.NorenApi import NorenApi
@@ -33,6 +33,38 @@ import pyalgomate.brokers.finvasia as finvasia
 logger = logging.getLogger(__name__)
 clickhouse_client = None
 
+# Ticks are buffered and written to ClickHouse in bulk by a background
+# thread so the websocket callback never waits on the network
+CLICKHOUSE_FLUSH_INTERVAL = 0.5
+CLICKHOUSE_FLUSH_ROWS = 1000
+CLICKHOUSE_COLUMNS = ["instrument", "timestamp", "ltp", "volume"]
+_ch_buffer = []
+_ch_lock = threading.Lock()
+_ch_flush_event = threading.Event()
+
+# The only quote fields published on FEED_BATCH; everything on the wire is
+# a plain msgpack primitive from this fixed set
+FEED_FIELDS = (
+    "_key",
+    "e",
+    "tk",
+    "lp",
+    "v",
+    "bp1",
+    "sp1",
+    "bq1",
+    "sq1",
+    "oi",
+    "ft",
+    "volume",
+)
+
+
+def toDateTime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp / 1000)
+
 
 def createClickhouseTable():
     query = """
@@ -48,28 +80,68 @@ def createClickhouseTable():
 
 
 def storeDataInClickhouse(data):
+    if clickhouse_client is None:
+        return
     try:
-        if clickhouse_client is None:
-            return
-        query = "INSERT INTO finvasia_market_data (instrument, timestamp, ltp, volume) VALUES"
-        values = (
+        # ft is epoch milliseconds, which is exactly a DateTime64(3) tick
+        row = [
             data["e"] + "|" + data["ts"],
-            data["ft"].strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            data["ft"],
             float(data["lp"]),
             float(data["volume"]),
-        )
-        clickhouse_client.command(f"{query} {values}")
+        ]
     except Exception as e:
         logger.error(f"Error storing data in ClickHouse: {e}")
+        return
+
+    with _ch_lock:
+        _ch_buffer.append(row)
+        bufferFull = len(_ch_buffer) >= CLICKHOUSE_FLUSH_ROWS
+
+    if bufferFull:
+        _ch_flush_event.set()
+
+
+def flushClickhouseBuffer():
+    global _ch_buffer
+    with _ch_lock:
+        if not _ch_buffer:
+            return
+        rows = _ch_buffer
+        _ch_buffer = []
+
+    try:
+        clickhouse_client.insert(
+            "finvasia_market_data", rows, column_names=CLICKHOUSE_COLUMNS
+        )
+    except Exception as e:
+        logger.error(f"Error storing {len(rows)} rows in ClickHouse: {e}")
+
+
+def runClickhouseFlusher():
+    while True:
+        _ch_flush_event.wait(CLICKHOUSE_FLUSH_INTERVAL)
+        _ch_flush_event.clear()
+        flushClickhouseBuffer()
 
 
 class WebSocketClient:
+    FLUSH_INTERVAL = 0.005
+    STATUS_INTERVAL = 60
 
     def __init__(self, api, tokenMappings, ipc_path=None):
         assert len(tokenMappings), "Missing subscriptions"
         self.__quotes = dict()
-        self.__lastQuoteDateTime = None
-        self.__lastReceivedDateTime = None
+        self.__lastSignatures = dict()
+        self.__pendingUpdates = dict()
+        self.__pendingUpdatesLock = threading.Lock()
+        self.__socketLock = threading.Lock()
+        # Packs into one reusable internal buffer instead of allocating a
+        # fresh bytes object per batch
+        self.__packer = msgpack.Packer(use_bin_type=True, autoreset=False)
+        self.__stopped = False
+        self.__lastQuoteTimestamp = None
+        self.__lastReceivedTimestamp = None
         self.__api: NorenApi = api
         self.__tokenMappings = tokenMappings
         self.__pendingSubscriptions = list()
@@ -95,9 +167,9 @@ class WebSocketClient:
         else:
             self.__socket.bind(f"ipc://{self.__ipc_path}")
 
-        self.periodicThread = threading.Thread(target=self.periodicPrint)
-        self.periodicThread.daemon = True
-        self.periodicThread.start()
+        self.flushThread = threading.Thread(target=self.flushPendingUpdates)
+        self.flushThread.daemon = True
+        self.flushThread.start()
 
     def startClient(self):
         self.__api.start_websocket(
@@ -112,6 +184,8 @@ class WebSocketClient:
         try:
             if self.__connected:
                 self.__api.close_websocket()
+                self.__stopped = True
+                self.flushThread.join()
                 self.__socket.close()
                 self.__context.term()
         except Exception as e:
@@ -129,11 +203,9 @@ class WebSocketClient:
             logger.error(f"Connection not opened in {timeout} secs. Stopping the feed")
             return False
 
+        pendingSubscriptions = set(self.__pendingSubscriptions)
         for _ in range(timeout):
-            if {
-                pendingSubscription
-                for pendingSubscription in self.__pendingSubscriptions
-            }.issubset(self.__quotes.keys()):
+            if pendingSubscriptions.issubset(self.__quotes.keys()):
                 self.__pendingSubscriptions.clear()
                 return True
             time.sleep(1)
@@ -165,53 +237,93 @@ class WebSocketClient:
     def onQuoteUpdate(self, message):
         try:
             key = message["e"] + "|" + message["tk"]
-            self.__lastReceivedDateTime = datetime.datetime.now()
-            message["ct"] = self.__lastReceivedDateTime
-
-            previousVolume = (
-                self.__quotes[key]["v"]
-                if key in self.__quotes and "v" in self.__quotes[key]
-                else 0
-            )
-            self.__lastQuoteDateTime = (
-                datetime.datetime.fromtimestamp(int(message["ft"]))
+            # Published with the quote so consumers need not rebuild it
+            message["_key"] = key
+            # Timestamps stay epoch milliseconds end to end; they are only
+            # turned into datetimes by whoever needs to display them
+            self.__lastReceivedTimestamp = int(time.time() * 1000)
+            message["ct"] = self.__lastReceivedTimestamp
+            message["ft"] = (
+                int(message["ft"]) * 1000
                 if "ft" in message
-                else self.__lastReceivedDateTime.replace(microsecond=0)
+                else self.__lastReceivedTimestamp // 1000 * 1000
             )
-            message["ft"] = self.__lastQuoteDateTime
-            if key in self.__quotes:
-                symbolInfo = self.__quotes[key]
-                symbolInfo.update(message)
-                self.__quotes[key] = symbolInfo
-            else:
-                self.__quotes[key] = message
+            self.__lastQuoteTimestamp = message["ft"]
+
+            quote = self.__quotes.setdefault(key, {})
+            previousVolume = quote.get("v", 0)
+            quote.update(message)
 
             if "v" in message:
-                self.__quotes[key]["volume"] = float(message["v"]) - float(
-                    previousVolume
-                )
-                self.__socket.send_multipart(
-                    [b"FEED_UPDATE", pickle.dumps(self.__quotes[key])]
-                )
-                storeDataInClickhouse(self.__quotes[key])
+                quote["volume"] = float(message["v"]) - float(previousVolume)
+                storeDataInClickhouse(quote)
             else:
-                self.__quotes[key]["volume"] = 0
-                self.__socket.send_multipart(
-                    [b"FEED_UPDATE", pickle.dumps(self.__quotes[key])]
-                )
+                quote["volume"] = 0
+
+            # Skip publishing when nothing a consumer reads has changed
+            signature = (
+                quote.get("lp"),
+                quote.get("v"),
+                quote.get("bp1"),
+                quote.get("sp1"),
+                quote.get("bq1"),
+                quote.get("sq1"),
+                quote.get("oi"),
+            )
+            if self.__lastSignatures.get(key) == signature:
+                return
+            self.__lastSignatures[key] = signature
+
+            # Only the latest state per token is kept; the flusher thread
+            # publishes whatever has accumulated since its previous run
+            with self.__pendingUpdatesLock:
+                self.__pendingUpdates[key] = {
+                    field: quote[field] for field in FEED_FIELDS if field in quote
+                }
         except Exception as e:
             logger.error(e)
 
     def onOrderUpdate(self, message):
         logger.info(f"Order update: {message}")
-        self.__socket.send_multipart([b"ORDER_UPDATE", json.dumps(message).encode()])
+        with self.__socketLock:
+            self.__socket.send_multipart(
+                [b"ORDER_UPDATE", json.dumps(message).encode()]
+            )
 
-    def periodicPrint(self):
-        while True:
+    def flushPendingUpdates(self):
+        # The status line is logged from here rather than a dedicated thread
+        nextStatusTime = time.monotonic()
+        while not self.__stopped:
+            time.sleep(self.FLUSH_INTERVAL)
+            if time.monotonic() >= nextStatusTime:
+                self.logStatus()
+                nextStatusTime += self.STATUS_INTERVAL
+
+            with self.__pendingUpdatesLock:
+                if not self.__pendingUpdates:
+                    continue
+                batch = self.__pendingUpdates
+                self.__pendingUpdates = dict()
+
+            try:
+                self.__packer.pack(batch)
+                # zmq copies the frame out of the packer's buffer, so it is
+                # safe to reset it as soon as the send returns
+                with self.__socketLock:
+                    self.__socket.send_multipart(
+                        [b"FEED_BATCH", self.__packer.getbuffer()],
+                        flags=zmq.NOBLOCK,
+                    )
+            except Exception as e:
+                logger.error(f"Failed to publish feed batch: {e}")
+            finally:
+                self.__packer.reset()
+
+    def logStatus(self):
+        if logger.isEnabledFor(logging.INFO):
             logger.info(
-                f"Last Quote: {self.__lastQuoteDateTime}\tLast Received: {self.__lastReceivedDateTime}"
+                f"Last Quote: {toDateTime(self.__lastQuoteTimestamp)}\tLast Received: {toDateTime(self.__lastReceivedTimestamp)}"
             )
-            time.sleep(60)
 
     def get_ipc_path(self):
         return self.__ipc_path
@@ -236,6 +348,8 @@ if __name__ == "__main__":
 
     logger.addHandler(fileHandler)
     logger.addHandler(consoleHandler)
+    # Handlers are attached directly, so skip walking up to the root logger
+    logger.propagate = False
 
     logging.getLogger("requests").setLevel(logging.WARNING)
 
@@ -274,6 +388,10 @@ if __name__ == "__main__":
         )
         createClickhouseTable()
 
+        clickhouseThread = threading.Thread(target=runClickhouseFlusher)
+        clickhouseThread.daemon = True
+        clickhouseThread.start()
+
     wsClient.startClient()
     if not wsClient.waitInitialized():
         exit(1)
@@ -284,3 +402,5 @@ if __name__ == "__main__":
             time.sleep(1)
     except KeyboardInterrupt:
         wsClient.stopClient()
+        if clickhouse_client is not None:
+            flushClickhouseBuffer()
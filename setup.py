@@ -67,6 +67,7 @@ setup(
         "pendulum",
         "streamlit",
         "pyzmq",
+        "msgpack",
         "aiohttp",
         "plotly",
         "py_vollib",